@@ -3,4 +3,4 @@ from .interface import Packable
 from .serialization import pack, unpack, SerializableType
 
 
-__version__ = '0.2.3'
+__version__ = '0.3.0'
@@ -1,183 +1,533 @@
 from __future__ import annotations
-from .errors import tressa
+from .errors import UsageError, tressa
 from .interface import Packable
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 from types import NoneType
 import struct
 
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
 
 SerializableType = Packable|dict|list|set|tuple|int|bool|float|Decimal|str|bytes|bytearray|NoneType
 
+_HDR = struct.Struct('!cI')
+_LEN = struct.Struct('!I')
+_BOOL = struct.Struct('!c?')
+_FLOAT = struct.Struct('!cd')
+_NULL = b'n'
+_VERSION = bytes((2,))
+_MAX_EXPANSION = 256
+_MIN_EXPANSION_BUDGET = 2**23
+_IMMUTABLE_TYPES = (str, bytes, int, float, bool, Decimal, NoneType)
+_GLOBALS = globals()
+
 
-def pack(data: SerializableType) -> bytes:
+def pack(data: SerializableType, *, compress: bool = False,
+         intern: bool = False) -> bytes:
     """Serializes an instance of a Packable implementation or built-in
         type, recursively calling itself as necessary. Raises UsageError
-        if the type is not serializable.
-    """
-    tressa(isinstance(data, Packable) or \
-        type(data) in (dict, list, set, tuple, str, bytes, bytearray, int,
-                       bool, float, Decimal) or data is None,
-        'data type must be one of (Packable, list, set, tuple, ' + \
-        'str, bytes, bytearray, int, bool, float, Decimal, NoneType); ' + \
-        f'{type(data)} is not serializable')
-
-    if isinstance(data, Packable):
-        packed = bytes(data.__class__.__name__, 'utf-8').hex()
-        packed = bytes(packed, 'utf-8') + b'_' + data.pack()
-        return struct.pack(
-            f'!1sI{len(packed)}s',
-            b'p',
-            len(packed),
-            packed
-        )
+        if the type is not serializable. If compress is True, the output
+        is compressed with blosc, which must be installed. If intern is
+        True, repeated values are replaced with back-references to
+        their first occurrence. The output starts with a format version
+        byte.
+    """
+    tressa(not compress or blosc is not None,
+        'blosc must be installed to use compress=True')
+    buf = bytearray(1 + _estimate(data))
+    buf[0:1] = _VERSION
+    pos = _pack(data, buf, 1, {} if intern else None)
+    del buf[pos:]
 
-    if type(data) in (list, set, tuple):
-        items = b''.join([pack(item) for item in data])
-        code = ({
-            list: b'l',
-            set: b'e',
-            tuple: b't'
-        })[type(data)]
-
-        return struct.pack(
-            f'!1sI{len(items)}s',
-            code,
-            len(items),
-            items
+    if compress:
+        return _VERSION + _HDR.pack(b'Z', len(buf)) + blosc.compress(
+            bytes(buf), typesize=1, cname='lz4', shuffle=blosc.BITSHUFFLE
         )
 
-    if type(data) in (bytes, bytearray):
-        return struct.pack(
-            f'!1sI{len(data)}s',
-            b'b' if type(data) is bytes else b'a',
-            len(data),
-            data
-        )
+    return bytes(buf)
 
-    if type(data) is str:
-        data = bytes(data, 'utf-8')
-        return struct.pack(
-            f'!1sI{len(data)}s',
-            b's',
-            len(data),
-            data
-        )
 
-    if type(data) is int:
-        return struct.pack(
-            f'!1sII',
-            b'i',
-            4,
-            data
-        )
+def _pack_bare(data: SerializableType) -> bytes:
+    """Serializes data without the format version byte, e.g. to sort
+        dict keys by their serialization.
+    """
+    buf = bytearray(_estimate(data))
+    pos = _pack(data, buf, 0)
+    del buf[pos:]
+    return bytes(buf)
 
-    if type(data) is bool:
-        return struct.pack(
-            f'!1sI?',
-            b'B',
-            1,
-            data
-        )
 
-    if type(data) is float:
-        return struct.pack(
-            f'!1sId',
-            b'f',
-            8,
-            data
-        )
+def _estimate(data: SerializableType) -> int:
+    """Returns the expected size of the serialization of data, used to
+        preallocate the output buffer. The estimate is exact for ASCII
+        str, bytes and fixed-width values and an upper bound for int;
+        non-ASCII str is underestimated, and Packable and Decimal values
+        get a flat guess, so the writer grows the buffer as needed.
+    """
+    data_type = type(data)
 
-    if type(data) is Decimal:
-        data = bytes(str(data), 'utf-8')
-        return struct.pack(
-            f'!1sI{len(data)}s',
-            b'D',
-            len(data),
-            data
-        )
+    if data_type is list or data_type is tuple or data_type is set:
+        size = 5
+        for item in data:
+            size += _estimate(item)
+        return size
 
-    if type(data) is dict:
-        items = b''.join(sorted([
-            pack((key, value))
-            for key, value in data.items()
-        ]))
-        return struct.pack(
-            f'!1sI{len(items)}s',
-            b'd',
-            len(items),
-            items
-        )
+    if data_type is dict:
+        size = 5
+        for key, value in data.items():
+            size += _estimate(key) + _estimate(value)
+        return size
 
-    if data is None:
-        return struct.pack(
-            f'!1sI',
-            b'n',
-            0
-        )
+    if data_type is str or data_type is bytes or data_type is bytearray:
+        return 5 + len(data)
+
+    if data_type is int:
+        return 2 + data.bit_length() // 7
+
+    return _SIZES.get(data_type, 64)
+
+
+def _reserve(buf: bytearray, pos: int, size: int) -> None:
+    """Grows buf so that size bytes can be written at pos. Only needed
+        when _estimate fell short.
+    """
+    short = pos + size - len(buf)
+    if short > 0:
+        buf.extend(bytes(max(short, len(buf))))
+
+
+def _write_framed(buf: bytearray, pos: int, tag: bytes,
+                  payload: bytes|bytearray) -> int:
+    """Writes tag, the length of payload, and payload into buf at pos.
+        Returns the position just past the payload.
+    """
+    end = pos + _HDR.size + len(payload)
+    _reserve(buf, pos, end - pos)
+    _HDR.pack_into(buf, pos, tag, len(payload))
+    buf[pos+_HDR.size:end] = payload
+    return end
+
+
+def _pack(data: SerializableType, buf: bytearray, pos: int,
+          seen: dict|None = None) -> int:
+    """Writes the serialization of data into buf at pos, recursing into
+        containers without creating intermediate bytes objects. Returns
+        the position just past the written value. Raises UsageError if
+        the type is not serializable. If seen is not None, values are
+        interned in it; see _intern.
+    """
+    encoder = _ENCODERS.get(type(data))
+    if encoder is None:
+        tressa(isinstance(data, Packable),
+            'data type must be one of (Packable, list, set, tuple, ' + \
+            'str, bytes, bytearray, int, bool, float, Decimal, NoneType); ' + \
+            f'{type(data)} is not serializable')
+        encoder = _pack_packable
+
+    if seen is None or encoder in _CONTAINER_ENCODERS:
+        return encoder(data, buf, pos, seen)
+
+    end = encoder(data, buf, pos, seen)
+    return _intern(buf, pos, end, seen, bytes(buf[pos:end]))
+
+
+def _intern(buf: bytearray, start: int, end: int, seen: dict, key) -> int:
+    """Interns the value written to buf[start:end] under key. If an
+        equal value was written before, it is overwritten with a 'R'
+        back-reference to that value's offset. Values no larger than a
+        back-reference are left alone. Returns the position just past
+        the value or the back-reference.
+    """
+    if end - start <= _HDR.size:
+        return end
+
+    offset = seen.get(key)
+    if offset is None:
+        seen[key] = start
+        return end
+
+    _HDR.pack_into(buf, start, b'R', offset)
+    return start + _HDR.size
+
+
+def _token(buf: bytearray, start: int, end: int):
+    """Returns a key identifying the (already interned) value written
+        to buf[start:end]: the offset it was interned at, the offset it
+        refers to, or its bytes if it was too small to be interned.
+    """
+    if buf[start] == 0x52:  # b'R'
+        return _LEN.unpack_from(buf, start+1)[0]
+    if end - start > _HDR.size:
+        return start
+    return bytes(buf[start:end])
+
+
+def _pack_packable(data: Packable, buf: bytearray, pos: int, seen: dict|None) -> int:
+    name = data.__class__.__name__.encode()
+    tressa(len(name) < 256,
+        f'{data.__class__.__name__} class name must be under 256 bytes')
+    return _write_framed(buf, pos, b'p', bytes((len(name),)) + name + data.pack())
+
+
+def _pack_items(code: bytes, data: list|set|tuple, buf: bytearray, pos: int,
+                seen: dict|None) -> int:
+    _reserve(buf, pos, 5)
+    start = pos + 5
+    pos = start
+    tokens = []
+    for item in data:
+        item_start = pos
+        pos = _pack(item, buf, pos, seen)
+        if seen is not None:
+            tokens.append(_token(buf, item_start, pos))
+    _HDR.pack_into(buf, start-5, code, pos-start)
+
+    if seen is None:
+        return pos
+    return _intern(buf, start-5, pos, seen, (code, *tokens))
+
+
+def _pack_list(data: list, buf: bytearray, pos: int, seen: dict|None) -> int:
+    return _pack_items(b'l', data, buf, pos, seen)
+
+
+def _pack_set(data: set, buf: bytearray, pos: int, seen: dict|None) -> int:
+    return _pack_items(b'e', data, buf, pos, seen)
+
+
+def _pack_tuple(data: tuple, buf: bytearray, pos: int, seen: dict|None) -> int:
+    return _pack_items(b't', data, buf, pos, seen)
+
+
+def _pack_bytes(data: bytes, buf: bytearray, pos: int, seen: dict|None) -> int:
+    return _write_framed(buf, pos, b'b', data)
+
+
+def _pack_bytearray(data: bytearray, buf: bytearray, pos: int, seen: dict|None) -> int:
+    return _write_framed(buf, pos, b'a', data)
+
+
+def _pack_str(data: str, buf: bytearray, pos: int, seen: dict|None) -> int:
+    return _write_framed(buf, pos, b's', data.encode())
 
 
-def unpack(data: bytes, inject: dict = {}) -> SerializableType:
+def _pack_int(data: int, buf: bytearray, pos: int, seen: dict|None) -> int:
+    _reserve(buf, pos, 2 + data.bit_length() // 7)
+    buf[pos] = 0x69  # b'i'
+    return _write_varint(buf, pos+1, data)
+
+
+def _pack_bool(data: bool, buf: bytearray, pos: int, seen: dict|None) -> int:
+    _reserve(buf, pos, _BOOL.size)
+    _BOOL.pack_into(buf, pos, b'B', data)
+    return pos + _BOOL.size
+
+
+def _pack_float(data: float, buf: bytearray, pos: int, seen: dict|None) -> int:
+    _reserve(buf, pos, _FLOAT.size)
+    _FLOAT.pack_into(buf, pos, b'f', data)
+    return pos + _FLOAT.size
+
+
+def _pack_decimal(data: Decimal, buf: bytearray, pos: int, seen: dict|None) -> int:
+    return _write_framed(buf, pos, b'D', str(data).encode())
+
+
+def _pack_dict(data: dict, buf: bytearray, pos: int, seen: dict|None) -> int:
+    items = sorted(
+        [(_pack_bare(key), value) for key, value in data.items()],
+        key=lambda item: item[0]
+    )
+    _reserve(buf, pos, 5)
+    start = pos + 5
+    pos = start
+    tokens = []
+    for key, value in items:
+        _reserve(buf, pos, len(key))
+        buf[pos:pos+len(key)] = key
+        if seen is None:
+            pos = _pack(value, buf, pos + len(key))
+            continue
+
+        key_start = pos
+        pos = _intern(buf, pos, pos + len(key), seen, key)
+        tokens.append(_token(buf, key_start, pos))
+        value_start = pos
+        pos = _pack(value, buf, pos, seen)
+        tokens.append(_token(buf, value_start, pos))
+    _HDR.pack_into(buf, start-5, b'd', pos-start)
+
+    if seen is None:
+        return pos
+    return _intern(buf, start-5, pos, seen, (b'd', *tokens))
+
+
+def _pack_none(data: None, buf: bytearray, pos: int, seen: dict|None) -> int:
+    _reserve(buf, pos, 1)
+    buf[pos:pos+1] = _NULL
+    return pos + 1
+
+
+# keyed on the exact type, so bool never falls through to int
+_ENCODERS = {
+    bool: _pack_bool,
+    int: _pack_int,
+    float: _pack_float,
+    str: _pack_str,
+    bytes: _pack_bytes,
+    bytearray: _pack_bytearray,
+    Decimal: _pack_decimal,
+    list: _pack_list,
+    tuple: _pack_tuple,
+    set: _pack_set,
+    dict: _pack_dict,
+    NoneType: _pack_none,
+}
+
+_CONTAINER_ENCODERS = (_pack_list, _pack_tuple, _pack_set, _pack_dict)
+
+_SIZES = {
+    bool: _BOOL.size,
+    float: _FLOAT.size,
+    NoneType: 1,
+    Decimal: 32,
+}
+
+
+def _write_varint(buf: bytearray, pos: int, n: int) -> int:
+    """Writes n into buf at pos as a zigzag LEB128 varint. Works for
+        ints of any size. Returns the position just past the varint.
+    """
+    n = n << 1 if n >= 0 else ((-n) << 1) - 1
+    while n > 0x7f:
+        buf[pos] = (n & 0x7f) | 0x80
+        n >>= 7
+        pos += 1
+    buf[pos] = n
+    return pos + 1
+
+
+def _read_varint(mv: memoryview, pos: int) -> tuple[int, int]:
+    """Reads a zigzag LEB128 varint starting at pos in mv. Returns the
+        int and the position just past it. Raises UsageError if the
+        varint is truncated.
+    """
+    tressa(pos < len(mv), 'data is truncated; cannot unpack')
+    n = mv[pos]
+    if n < 0x80:
+        return (n >> 1) ^ -(n & 1), pos + 1
+
+    n &= 0x7f
+    shift = 7
+    pos += 1
+    while True:
+        tressa(pos < len(mv), 'data is truncated; cannot unpack')
+        byte = mv[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (n >> 1) ^ -(n & 1), pos
+
+
+def _resolve(name: str, inject: dict) -> type[Packable]:
+    """Looks up the named Packable class in inject, falling back to the
+        module globals. Raises UsageError if it cannot be found or has
+        no unpack method.
+    """
+    cls = inject.get(name)
+    if cls is None:
+        cls = _GLOBALS.get(name)
+    tressa(cls is not None,
+        f'{name} not found in globals or inject; cannot unpack')
+    tressa(hasattr(cls, 'unpack'), f'{name} must have unpack method')
+    return cls
+
+
+class _References:
+    """Tracks the state of back-reference resolution during one unpack
+        call: decoded immutable values by offset, the offsets currently
+        being decoded through a reference, and the number of bytes that
+        may still be re-decoded through references.
+    """
+    def __init__(self, budget: int) -> None:
+        self.cache = {}
+        self.active = set()
+        self.budget = budget
+
+
+def unpack(data: bytes, inject: dict = {}, *, intern: bool = False,
+           max_expansion: int|None = None) -> SerializableType:
     """Deserializes an instance of a Packable implementation
         or built-in type, recursively calling itself as necessary.
+        Output of pack(..., compress=True) is decompressed first.
+        Back-references written by pack(..., intern=True) are only
+        followed if intern is True. At most max_expansion bytes are
+        re-decoded through them; by default the larger of 8 MiB and
+        256 times the size of the data. Raises UsageError if the format
+        version is not supported or the data is truncated or malformed;
+        errors raised by a Packable class's own unpack method are not
+        converted.
+    """
+    tressa(data[:1] == _VERSION,
+        f'unsupported format version {bytes(data[:1])}; cannot unpack')
+
+    if data[1:2] == b'Z':
+        tressa(blosc is not None,
+            'blosc must be installed to unpack compressed data')
+        tressa(len(data) >= 1 + _HDR.size,
+            'compressed data is truncated; cannot unpack')
+        raw_len = _LEN.unpack_from(data, 2)[0]
+        try:
+            data = blosc.decompress(bytes(data[1+_HDR.size:]))
+        except Exception as e:
+            raise UsageError(f'cannot decompress data: {e}') from e
+        tressa(len(data) == raw_len and data[:1] == _VERSION,
+            'decompressed data is corrupt; cannot unpack')
+
+    if max_expansion is None:
+        max_expansion = max(_MIN_EXPANSION_BUDGET, _MAX_EXPANSION * len(data))
+    refs = _References(max_expansion) if intern else None
+    mv = memoryview(data)
+    value, end = _unpack(mv, 1, inject, refs)
+    tressa(end == len(mv), 'data has trailing bytes; cannot unpack')
+    return value
+
+
+def _decode_str(view: memoryview) -> str:
+    """Decodes a UTF-8 payload. Raises UsageError if it is not valid
+        UTF-8.
+    """
+    try:
+        return str(view, 'utf-8')
+    except UnicodeDecodeError as e:
+        raise UsageError(f'invalid UTF-8 data: {e}') from e
+
+
+def _read_len(mv: memoryview, pos: int) -> int:
+    """Reads the length field of the record starting at pos in mv.
+        Raises UsageError if the header is truncated.
     """
-    code, data = struct.unpack(f'!1s{len(data)-1}s', data)
-    dependencies = {**globals(), **inject}
+    tressa(pos + _HDR.size <= len(mv), 'data is truncated; cannot unpack')
+    return _LEN.unpack_from(mv, pos+1)[0]
+
+
+def _read_framed(mv: memoryview, pos: int) -> tuple[memoryview, int]:
+    """Reads the length-prefixed payload of the value starting at pos in
+        mv. Returns a view of the payload and the position just past it.
+    """
+    end = pos + _HDR.size + _read_len(mv, pos)
+    tressa(end <= len(mv), 'data is truncated; cannot unpack')
+    return mv[pos+_HDR.size:end], end
+
+
+def _unpack(mv: memoryview, pos: int, inject: dict,
+            refs: _References|None) -> tuple[SerializableType, int]:
+    """Deserializes the value starting at pos in mv, recursing into
+        containers without copying their contents. Returns the value
+        and the position just past it. 'R' back-references are rejected
+        unless refs is given.
+    """
+    code = mv[pos:pos+1].tobytes()
+
+    if code == b'R':
+        tressa(refs is not None,
+            'data contains back-references; unpack with intern=True')
+        offset = _read_len(mv, pos)
+        tressa(offset < pos, 'back-reference must point to an earlier value')
+        if offset in refs.cache:
+            return refs.cache[offset], pos + _HDR.size
+
+        tressa(offset not in refs.active,
+            'back-reference must not point to an enclosing value')
+        refs.active.add(offset)
+        value, end = _unpack(mv, offset, inject, refs)
+        refs.active.remove(offset)
+        tressa(end <= pos, 'back-reference must point to an earlier value')
+        refs.budget -= end - offset
+        tressa(refs.budget >= 0,
+            'back-references expand beyond the size limit; cannot ' + \
+            'unpack without a larger max_expansion')
+        if type(value) in _IMMUTABLE_TYPES:
+            refs.cache[offset] = value
+        return value, pos + _HDR.size
 
     if code == b'p':
-        packed_len, data = struct.unpack(f'!I{len(data)-4}s', data)
-        packed, _ = struct.unpack(f'!{packed_len}s{len(data)-packed_len}s', data)
-        packed_class, _, packed_data = packed.partition(b'_')
-        packed_class = str(bytes.fromhex(str(packed_class, 'utf-8')), 'utf-8')
-        tressa(packed_class in dependencies,
-            f'{packed_class} not found in globals or inject; cannot unpack')
-        tressa(hasattr(dependencies[packed_class], 'unpack'),
-            f'{packed_class} must have unpack method')
-        return dependencies[packed_class].unpack(packed_data, inject=inject)
-
-    if code in (b'l', b'e', b't', b'd'):
-        let_len, data = struct.unpack(f'!I{len(data)-4}s', data)
-        let_data, _ = struct.unpack(f'!{let_len}s{len(data)-let_len}s', data)
+        packed, end = _read_framed(mv, pos)
+        tressa(len(packed) > 0 and 1 + packed[0] <= len(packed),
+            'Packable record is malformed; cannot unpack')
+        name_end = 1 + packed[0]
+        packed_class = _resolve(_decode_str(packed[1:name_end]), inject)
+        return packed_class.unpack(packed[name_end:].tobytes(), inject=inject), end
+
+    if code == b'd':
+        let_len = _read_len(mv, pos)
+        end = pos + 5 + let_len
+        tressa(end <= len(mv), 'data is truncated; cannot unpack')
+        pos += 5
+        items = {}
+        while pos < end:
+            key, pos = _unpack(mv, pos, inject, refs)
+            value, pos = _unpack(mv, pos, inject, refs)
+            try:
+                items[key] = value
+            except TypeError as e:
+                raise UsageError(f'dict key is malformed: {e}') from e
+        tressa(pos == end, f'{code} item overruns its container; cannot unpack')
+        return items, end
+
+    if code in (b'l', b'e', b't'):
+        let_len = _read_len(mv, pos)
+        end = pos + 5 + let_len
+        tressa(end <= len(mv), 'data is truncated; cannot unpack')
+        pos += 5
         items = []
-        while len(let_data) > 0:
-            _, item_len, _ = struct.unpack(f'!1sI{len(let_data)-5}s', let_data)
-            item, let_data = struct.unpack(
-                f'!{5+item_len}s{len(let_data)-5-item_len}s',
-                let_data
-            )
-            items.append(unpack(item, inject=inject))
+        while pos < end:
+            item, pos = _unpack(mv, pos, inject, refs)
+            items.append(item)
+        tressa(pos == end, f'{code} item overruns its container; cannot unpack')
 
         if code == b'l':
-            return items
+            return items, end
         if code == b'e':
-            return set(items)
-        if code == b't':
-            return tuple(items)
-        if code == b'd':
-            return {pair[0]: pair[1] for pair in items}
+            try:
+                return set(items), end
+            except TypeError as e:
+                raise UsageError(f'set item is malformed: {e}') from e
+        return tuple(items), end
 
     if code in (b'b', b'a'):
-        bt_len, data = struct.unpack(f'!I{len(data)-4}s', data)
-        bt_data, _ = struct.unpack(f'!{bt_len}s{len(data)-bt_len}s', data)
-        return bt_data if code == b'b' else bytearray(bt_data)
+        bt_data, end = _read_framed(mv, pos)
+        return (bt_data.tobytes() if code == b'b' else bytearray(bt_data)), end
 
     if code == b's':
-        s_len, data = struct.unpack(f'!I{len(data)-4}s', data)
-        s, _ = struct.unpack(f'!{s_len}s{len(data)-s_len}s', data)
-        return str(s, 'utf-8')
+        s, end = _read_framed(mv, pos)
+        return _decode_str(s), end
 
     if code == b'i':
-        return struct.unpack(f'!II{len(data)-8}s', data)[1]
+        return _read_varint(mv, pos+1)
 
     if code == b'B':
-        return struct.unpack(f'!I?', data)[1]
+        tressa(pos + _BOOL.size <= len(mv), 'data is truncated; cannot unpack')
+        return _BOOL.unpack_from(mv, pos)[1], pos + _BOOL.size
 
     if code == b'f':
-        return struct.unpack(f'!Id{len(data)-12}s', data)[1]
+        tressa(pos + _FLOAT.size <= len(mv), 'data is truncated; cannot unpack')
+        return _FLOAT.unpack_from(mv, pos)[1], pos + _FLOAT.size
 
     if code == b'D':
-        s_len, data = struct.unpack(f'!I{len(data)-4}s', data)
-        s, _ = struct.unpack(f'!{s_len}s{len(data)-s_len}s', data)
-        return Decimal(str(s, 'utf-8'))
+        s, end = _read_framed(mv, pos)
+        try:
+            return Decimal(_decode_str(s)), end
+        except InvalidOperation as e:
+            raise UsageError('Decimal is malformed; cannot unpack') from e
 
     if code == b'n':
-        return None
+        return None, pos + 1
+
+    tressa(False, f'unrecognized type code {code}; cannot unpack')
+
@@ -1,9 +1,18 @@
 from __future__ import annotations
-from context import pack, unpack, Packable, UsageError
+from context import packify, pack, unpack, Packable, UsageError
 from dataclasses import dataclass, field
 from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import patch
+import random
 import struct
 import unittest
+import zlib
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
 
 
 @dataclass
@@ -17,11 +26,11 @@ class StrWrapper:
         return hash(("StrWrapper", self.data))
 
     def pack(self) -> bytes:
-        return bytes(self.data, 'utf-8')
+        return self.data.encode()
 
     @classmethod
     def unpack(cls, data: bytes, /, *, inject: dict = {}) -> StrWrapper:
-        return cls(str(data, 'utf-8'))
+        return cls(data.decode())
 
 
 class PackableMapEntry:
@@ -44,10 +53,10 @@ class PackableMapEntry:
             other.value == self.value
 
     def pack(self) -> bytes:
-        key = bytes(self.key.__class__.__name__, 'utf-8').hex()
-        key = bytes(key, 'utf-8') + b'_' + self.key.pack()
-        value = bytes(self.value.__class__.__name__, 'utf-8').hex()
-        value = bytes(value, 'utf-8') + b'_' + self.value.pack()
+        key = self.key.__class__.__name__.encode()
+        key = struct.pack('!B', len(key)) + key + self.key.pack()
+        value = self.value.__class__.__name__.encode()
+        value = struct.pack('!B', len(value)) + value + self.value.pack()
         return struct.pack(
             f'!HH{len(key)}s{len(value)}s',
             len(key),
@@ -60,17 +69,16 @@ class PackableMapEntry:
     def unpack(cls, data: bytes, inject: dict = {}) -> PackableMapEntry:
         key_len, value_len, data = struct.unpack(f'!HH{len(data)-4}s', data)
         key_data, value_data = struct.unpack(f'{key_len}s{value_len}s', data)
-        dependencies = {**globals(), **inject}
 
         assert type(key_data) is bytes
-        key_class, key_data = key_data.split(b'_', 1)
-        key_class = str(bytes.fromhex(str(key_class, 'utf-8')), 'utf-8')
-        key = dependencies[key_class].unpack(key_data, inject=inject)
+        key_class = key_data[1:1+key_data[0]].decode()
+        key_data = key_data[1+key_data[0]:]
+        key = (inject.get(key_class) or globals()[key_class]).unpack(key_data, inject=inject)
 
         assert type(value_data) is bytes
-        value_class, value_data = value_data.split(b'_', 1)
-        value_class = str(bytes.fromhex(str(value_class, 'utf-8')), 'utf-8')
-        value = dependencies[value_class].unpack(value_data, inject=inject)
+        value_class = value_data[1:1+value_data[0]].decode()
+        value_data = value_data[1+value_data[0]:]
+        value = (inject.get(value_class) or globals()[value_class]).unpack(value_data, inject=inject)
 
         return cls(key, value)
 
@@ -98,6 +106,15 @@ class TestSerialization(unittest.TestCase):
             assert type(unpacked) is type(vector)
             assert unpacked == vector
 
+    def test_pack_and_unpack_ints_of_any_size(self):
+        vectors = [
+            0, 1, -1, 63, -64, 64, -65, 2**31, -2**31 - 1, 2**64, -2**100,
+            int('9' * 50),
+        ]
+        for vector in vectors:
+            assert unpack(pack(vector)) == vector
+        assert len(pack(1)) < len(pack(2**32))
+
     def test_pack_and_unpack_list_e2e(self):
         data = [
             "hello world",
@@ -202,6 +219,7 @@ class TestSerialization(unittest.TestCase):
         packed = pack(vector)
         for _ in range(100):
             assert pack(vector) == packed
+        assert pack(dict(reversed(vector.items()))) == packed
 
     def test_pack_set_is_deterministic(self):
         vector = {
@@ -220,6 +238,282 @@ class TestSerialization(unittest.TestCase):
             pack(lambda: None)
         assert "<class 'function'> is not serializable" in str(e.exception)
 
+    def test_pack_values_larger_than_estimate(self):
+        serialization = packify.serialization
+        vectors = [
+            'é' * 1000,
+            StrWrapper('x' * 1000),
+            Decimal('1.' + '1' * 100),
+            ['é' * 1000, StrWrapper('x' * 1000), Decimal('1.' + '1' * 100)],
+            {'é' * 100: StrWrapper('é' * 500), 'd': (Decimal('1.' + '1' * 100),)},
+        ]
+        for vector in vectors:
+            packed = pack(vector)
+            interned = pack(vector, intern=True)
+            assert serialization._estimate(vector) < len(packed)
+            assert unpack(packed, inject=self.inject) == vector
+
+            # packing into a buffer grown from empty gives the same bytes
+            with patch.object(serialization, '_estimate', return_value=0):
+                assert pack(vector) == packed
+                assert pack(vector, intern=True) == interned
+
+    def test_pack_and_unpack_large_container_e2e(self):
+        data = [(i, str(i), b'x') for i in range(10000)]
+        assert unpack(pack(data)) == data
+
+    def test_unpack_truncated_data_raises_error(self):
+        packed = pack([
+            'hello world', [1, 2**70, -3], 1.5, True, None, Decimal('1.25'),
+            {'key': b'value'}, StrWrapper('abc'),
+        ])
+        for i in range(1, len(packed)):
+            with self.assertRaises(UsageError):
+                unpack(packed[:-i], inject=self.inject)
+
+        for truncated in (b'\x02s\x00\x00', b'\x02i', b'\x02i\x80', b'\x02f\x00',
+                          b'\x02B', b'\x02R\x00', b'\x02l\x00\x00\x00',
+                          b'\x02p\x00\x00\x00\x00', b'\x02p\x00\x00\x00\x01\x05'):
+            with self.assertRaises(UsageError):
+                unpack(truncated, intern=True)
+
+    def test_unpack_trailing_bytes_raises_error(self):
+        for vector in (1, 'abc', [1, 2], {'a': None}, None):
+            with self.assertRaises(UsageError) as e:
+                unpack(pack(vector) + b'junk')
+            assert 'trailing bytes' in str(e.exception)
+
+    def test_unpack_unsupported_version_raises_error(self):
+        packed = pack([1, 2.5, True, None])
+        assert len(packed) == 1 + 5 + 2 + 9 + 2 + 1
+        with self.assertRaises(UsageError) as e:
+            unpack(b'\xff' + packed[1:])
+        assert 'unsupported format version' in str(e.exception)
+
+    def test_unpack_missing_class_raises_error(self):
+        packed = pack(StrWrapper("abc"))
+        with self.assertRaises(UsageError) as e:
+            unpack(packed)
+        assert "StrWrapper not found" in str(e.exception)
+        assert unpack(packed, inject=self.inject) == StrWrapper("abc")
+
+    def test_pack_and_unpack_interned_e2e(self):
+        record = {
+            'name': StrWrapper('some name'),
+            'tags': ['first tag', 'second tag'],
+        }
+        data = [record, dict(record), {'records': [record, record]}]
+        packed = pack(data, intern=True)
+        assert len(packed) < len(pack(data))
+        assert pack(data, intern=True) == packed
+        unpacked = unpack(packed, inject=self.inject, intern=True)
+        assert unpacked == data
+
+        # back-referenced values are decoded into distinct objects
+        unpacked[0]['tags'].append('third tag')
+        assert unpacked[1]['tags'] == ['first tag', 'second tag']
+
+    def test_unpack_interned_requires_opt_in(self):
+        packed = pack(['repeated value'] * 3, intern=True)
+        with self.assertRaises(UsageError) as e:
+            unpack(packed)
+        assert 'intern=True' in str(e.exception)
+        assert unpack(packed, intern=True) == ['repeated value'] * 3
+
+    def test_pack_and_unpack_interned_dict_keys(self):
+        data = [
+            {'a long key name': i, 'another long key': str(i), (1, 'tuple key'): None}
+            for i in range(10)
+        ]
+        packed = pack(data, intern=True)
+        assert len(packed) < len(pack(data))
+        assert unpack(packed, intern=True) == data
+
+    def test_pack_and_unpack_interned_subtrees_in_sets_and_tuples(self):
+        subtree = ('abcdefgh', (1.5, 'ijklmnop'), Decimal('123.456'))
+        data = {
+            'tuple': (subtree, subtree, [subtree]),
+            'set': {subtree, ('other', subtree)},
+            'again': (subtree, subtree, [subtree]),
+        }
+        packed = pack(data, intern=True)
+        # the whole repeated subtree collapses into a single reference
+        assert len(packed) < len(pack(subtree)) + len(pack(data)) // 2
+        assert unpack(packed, intern=True) == data
+
+    def test_pack_and_unpack_interned_nested_references(self):
+        # the second inner is a reference to the first, which itself
+        # contains a reference to its first string
+        inner = ['abcdefghijklmnop', 'abcdefghijklmnop']
+        data = [inner, inner, [inner, inner]]
+        packed = pack(data, intern=True)
+        unpacked = unpack(packed, intern=True)
+        assert unpacked == data
+        assert unpacked[0] is not unpacked[1]
+        assert unpacked[2][0] is not unpacked[2][1]
+
+    def test_unpack_malformed_reference_raises_error(self):
+        def with_reference(offset: int) -> bytes:
+            # a list holding only a back-reference, which sits at offset 6
+            return b'\x02' + struct.pack('!cI', b'l', 5) + struct.pack('!cI', b'R', offset)
+
+        for offset in (0, 1, 6, 7, 999):
+            with self.assertRaises(UsageError):
+                unpack(with_reference(offset), intern=True)
+
+    def test_unpack_interned_large_repeated_container(self):
+        big = [f'item{i:06d}' for i in range(200)]
+        data = [big] * 300
+        packed = pack(data, intern=True)
+        assert len(packed) < len(pack(big)) * 2
+        assert unpack(packed, intern=True) == data
+
+        with self.assertRaises(UsageError) as e:
+            unpack(packed, intern=True, max_expansion=len(pack(big)) * 10)
+        assert 'max_expansion' in str(e.exception)
+
+    def test_unpack_reference_expansion_is_bounded(self):
+        # each level is a list of two references to the level before it,
+        # so decoding the last level would produce 2**40 strings
+        body = struct.pack('!cI', b's', 8) + b'abcdefgh'
+        previous = 6
+        for _ in range(40):
+            offset = 6 + len(body)
+            body += struct.pack('!cI', b'l', 10)
+            body += struct.pack('!cI', b'R', previous) * 2
+            previous = offset
+        packed = b'\x02' + struct.pack('!cI', b'l', len(body)) + body
+        assert len(packed) < 700
+        with self.assertRaises(UsageError) as e:
+            unpack(packed, intern=True)
+        assert 'size limit' in str(e.exception)
+
+    @unittest.skipIf(blosc is None, 'blosc is not installed')
+    def test_pack_and_unpack_compressed_e2e(self):
+        data = {
+            'list': [StrWrapper('abc') for _ in range(100)],
+            'bytes': b'yellow submarine' * 100,
+        }
+        packed = pack(data, compress=True)
+        assert len(packed) < len(pack(data))
+        assert unpack(packed, inject=self.inject) == data
+
+    @unittest.skipIf(blosc is not None, 'blosc is installed')
+    def test_pack_compressed_without_blosc_raises_error(self):
+        with self.assertRaises(UsageError) as e:
+            pack([1, 2, 3], compress=True)
+        assert 'blosc' in str(e.exception)
+
+    def test_compressed_envelope_with_stubbed_blosc(self):
+        stub = SimpleNamespace(
+            BITSHUFFLE=2,
+            compress=lambda data, **kwargs: zlib.compress(data),
+            decompress=zlib.decompress,
+        )
+        data = {'list': [StrWrapper('abc')] * 100, 'bytes': b'yellow submarine' * 100}
+        with patch.object(packify.serialization, 'blosc', stub):
+            packed = pack(data, compress=True)
+            assert packed[1:2] == b'Z'
+            assert len(packed) < len(pack(data))
+            assert unpack(packed, inject=self.inject) == data
+
+            for corrupt in (packed[:2], packed[:6], packed[:-10], packed[:6] + b'junk'):
+                with self.assertRaises(UsageError):
+                    unpack(corrupt, inject=self.inject)
+
+            # wrong length recorded in the envelope
+            with self.assertRaises(UsageError):
+                unpack(packed[:2] + struct.pack('!I', 1) + packed[6:])
+
+
+def generate_basic_type(rng: random.Random, hashable: bool = False):
+    """Generates a random value of a hashable built-in or Packable type,
+        or also a bytearray if hashable is False, drawing from rng.
+    """
+    choices = ['int', 'float', 'str', 'bytes', 'bool', 'None', 'Decimal', 'StrWrapper']
+    if not hashable:
+        choices.append('bytearray')
+    kind = rng.choice(choices)
+    if kind == 'int':
+        return rng.randint(-1000000, 1000000)
+    if kind == 'float':
+        return rng.uniform(-1000000, 1000000)
+    if kind == 'str':
+        return ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(1, 20)))
+    if kind == 'bytes':
+        return rng.randbytes(rng.randint(1, 20))
+    if kind == 'bytearray':
+        return bytearray(rng.randbytes(rng.randint(1, 20)))
+    if kind == 'bool':
+        return rng.choice([True, False])
+    if kind == 'None':
+        return None
+    if kind == 'Decimal':
+        return Decimal(rng.randint(-1000000, 1000000)) / 1000
+    return StrWrapper(''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(1, 20))))
+
+
+def generate_vector(rng: random.Random, depth: int = 3):
+    """Generates a random tree of containers of the given depth with
+        basic types at the leaves, drawing from rng.
+    """
+    if depth == 0:
+        return generate_basic_type(rng)
+    kind = rng.choice(['list', 'tuple', 'set', 'dict'])
+    size = rng.randint(0, 5)
+    if kind == 'list':
+        return [generate_vector(rng, depth - 1) for _ in range(size)]
+    if kind == 'tuple':
+        return tuple(generate_vector(rng, depth - 1) for _ in range(size))
+    if kind == 'set':
+        return {generate_basic_type(rng, hashable=True) for _ in range(size)}
+    return {
+        generate_basic_type(rng, hashable=True): generate_vector(rng, depth - 1)
+        for _ in range(size)
+    }
+
+
+class TestFuzz(unittest.TestCase):
+    def test_fuzz_pack_and_unpack_e2e(self):
+        seed = random.randrange(2**32)
+        rng = random.Random(seed)
+        inject = {"StrWrapper": StrWrapper}
+        for _ in range(200):
+            vector = generate_vector(rng, rng.randint(0, 3))
+            packed = pack(vector)
+            assert pack(vector) == packed, f'seed={seed}'
+            assert unpack(packed, inject=inject) == vector, f'seed={seed}: {vector}'
+
+    def test_fuzz_unpack_mutated_data_raises_usage_error(self):
+        seed = random.randrange(2**32)
+        rng = random.Random(seed)
+        # accepts any payload, so only packify's own decoding can fail
+        inject = {"StrWrapper": SimpleNamespace(unpack=lambda data, inject={}: data)}
+        for _ in range(1000):
+            vector = generate_vector(rng, rng.randint(1, 3))
+            packed = bytearray(pack([vector, vector], intern=rng.random() < 0.5))
+            for _ in range(rng.randint(1, 3)):
+                packed[rng.randrange(1, len(packed))] = rng.randrange(256)
+            try:
+                unpack(bytes(packed), inject=inject, intern=True)
+            except UsageError:
+                pass
+            except Exception as e:
+                raise AssertionError(f'seed={seed}: {e!r} escaped for {bytes(packed)}') from e
+
+    def test_fuzz_pack_and_unpack_interned_e2e(self):
+        seed = random.randrange(2**32)
+        rng = random.Random(seed)
+        inject = {"StrWrapper": StrWrapper}
+        for _ in range(200):
+            vector = generate_vector(rng, rng.randint(0, 3))
+            vector = [vector, vector, {'nested': vector}]
+            packed = pack(vector, intern=True)
+            assert pack(vector, intern=True) == packed, f'seed={seed}'
+            assert len(packed) <= len(pack(vector)), f'seed={seed}'
+            unpacked = unpack(packed, inject=inject, intern=True)
+            assert unpacked == vector, f'seed={seed}: {vector}'
+
 
 class TestReportedEdgeCases(unittest.TestCase):
     def test_pack_and_unpack_specific_dict(self):